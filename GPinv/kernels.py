@@ -56,11 +56,11 @@ class Kern(object):
     def Cholesky(self, X):
         core = self._Kcore(X, X2=None) + \
                     eye(tf.shape(X)[0]) * settings.numerics.jitter_level
-        chol = tf.cholesky(core)
-        var = tf.tile(tf.expand_dims(tf.expand_dims(
-                            tf.sqrt(self.variance), 0),0),
-                    [tf.shape(core)[0],tf.shape(core)[1],1])
-        return var * tf.tile(tf.expand_dims(chol, -1),[1,1,tf.shape(var)[2]])
+        # Cholesky of small matrices is much faster by LAPACK than on GPU.
+        with tf.device('/cpu:0'):
+            chol = tf.cholesky(core)
+        # chol [n,n,1] is broadcast against sqrt(variance) [R]
+        return tf.expand_dims(chol, -1) * tf.sqrt(self.variance)
 
     def _Kcore(self, X, X2=None):
         """
@@ -51,16 +51,15 @@ class RBF2D(kernels.RBF):
         Overwrite cholesky for the speed up.
         X should be dim2*dim2
         """
-        chol_dim1 = tf.cholesky(
-                self._Kcore(self.dim1, X2=None) + \
-                eye(tf.shape(self.dim1)[0]) * settings.numerics.jitter_level)
-        chol_dim2 = tf.cholesky(
-                self._Kcore(self.dim2, X2=None) + \
-                eye(tf.shape(self.dim2)[0]) * settings.numerics.jitter_level)
+        K_dim1 = self._Kcore(self.dim1, X2=None) + \
+                eye(tf.shape(self.dim1)[0]) * settings.numerics.jitter_level
+        K_dim2 = self._Kcore(self.dim2, X2=None) + \
+                eye(tf.shape(self.dim2)[0]) * settings.numerics.jitter_level
+        # Cholesky of small matrices is much faster by LAPACK than on GPU.
+        with tf.device('/cpu:0'):
+            chol_dim1 = tf.cholesky(K_dim1)
+            chol_dim2 = tf.cholesky(K_dim2)
         # core of the cholesky
         chol = kronecker_product(chol_dim1, chol_dim2)
-        # expand and tile
-        var = tf.tile(tf.expand_dims(tf.expand_dims(
-                            tf.sqrt(self.variance), 0),0),
-                    [tf.shape(chol)[0],tf.shape(chol)[1],1])
-        return var * tf.tile(tf.expand_dims(chol, -1),[1,1,tf.shape(var)[2]])
+        # expand and broadcast against sqrt(variance) [R]
+        return tf.expand_dims(chol, -1) * tf.sqrt(self.variance)
@@ -72,7 +72,7 @@ class Gaussian(Likelihood):
         :param F tf.tensor(N,n,R): Sample from the posterior
         :param Y tf.tensor(n,R): Observation
         """
-        Y = tf.tile(tf.expand_dims(Y, 0), [tf.shape(F)[0],1,1])
+        # Y is broadcast along the sample axis of F without tiling.
         return densities.gaussian(F, Y, self.variance)
 
     def sample_F(self, F):
@@ -21,7 +21,7 @@ import tensorflow as tf
 import numpy as np
 from GPflow.densities import gaussian
 from GPflow.model import GPModel
-from GPflow import transforms,kullback_leiblers
+from GPflow import transforms
 from GPflow.param import AutoFlow
 from GPflow.tf_wraps import eye
 from GPflow._settings import settings
@@ -31,6 +31,55 @@ from . import conditionals
 float_type = settings.dtypes.float_type
 np_float_type = np.float32 if float_type is tf.float32 else np.float64
 
+class PackedLowerTriangular(transforms.Transform):
+    """
+    Transform for a set of lower triangular matrices sized [n,n,R].
+    Only the lower triangular elements are stored as the free state, with
+    the packed layout [n(n+1)/2, R], so that the optimizer handles about half
+    of the elements.
+
+    The matrix is reconstructed by tf.gather, so that the upper triangular
+    part is always exactly zero and no custom op is necessary.
+    """
+    def __init__(self, n, num_matrices=1):
+        """
+        :param integer n: size of the matrix.
+        :param integer num_matrices: number of matrices, R.
+        """
+        self.n = n
+        self.num_matrices = num_matrices
+        # indices of the lower triangular elements.
+        self._tril = np.tril_indices(n)
+        # Index of the packed vector for each element of the matrix.
+        # The upper triangular part refers to the additional zero row.
+        size = n*(n+1)//2
+        self._index = np.full((n, n), size, dtype=np.int32)
+        self._index[self._tril] = np.arange(size, dtype=np.int32)
+
+    def forward(self, x):
+        y = np.zeros((self.n, self.n, self.num_matrices), np_float_type)
+        y[self._tril] = x.reshape(-1, self.num_matrices)
+        return y
+
+    def backward(self, y):
+        # Param passes the flattened value.
+        y = np.reshape(y, (self.n, self.n, self.num_matrices))
+        return y[self._tril].flatten()
+
+    def tf_forward(self, x):
+        packed = tf.concat(0, [tf.reshape(x, [-1, self.num_matrices]),
+                               tf.zeros([1, self.num_matrices], float_type)])
+        return tf.gather(packed, self._index) # [n,n,R]
+
+    def tf_log_jacobian(self, x):
+        return tf.zeros((1,), float_type)
+
+    def free_state_size(self, variable_shape):
+        return self.n*(self.n+1)//2*self.num_matrices
+
+    def __str__(self):
+        return 'PackedLoTri'
+
 class StVGP(GPModel):
     """
     Stochastic approximation of the Variational Gaussian process
@@ -46,11 +95,17 @@ class StVGP(GPModel):
         kern, likelihood, mean_function are appropriate GPflow objects
         q_diag: True for diagonal approximation of q.
         KL_analytic: True for the use of the analytical expression for KL.
+            Since the expectation of the stochastic KL estimator is evaluated
+            exactly, this coincides with the default and is kept only for
+            compatibility.
         num_samples: number of samples to approximate the posterior.
+            Since antithetic pairs of samples are used, an even number is
+            recommended.
+            This is stored as DataHolder, so that it can be changed without
+            recompilation, e.g. m.num_samples.set_data(np.array(40)).
         """
         self.num_data = X.shape[0] # number of data, n
         self.num_latent = num_latent or Y.shape[1] # number of latent function, R
-        self.num_samples = num_samples # number of samples to approximate integration, N
         if mean_function is None:
             mean_function = Zero(self.num_latent)
         # if minibatch_size is not None, Y is stored as MinibatchData.
@@ -58,21 +113,36 @@ class StVGP(GPModel):
         Y = DataHolder(Y, on_shape_change='recompile')
         X = DataHolder(X, on_shape_change='recompile')
         GPModel.__init__(self, X, Y, kern, likelihood, mean_function)
+        # number of samples to approximate integration, N
+        self.num_samples = DataHolder(np.array(num_samples, dtype=np.int32),
+                                      on_shape_change='pass')
         # variational parameter.
         # Mean of the posterior
         self.q_mu = Param(np.zeros((self.num_data, self.num_latent)))
         # If true, mean-field approimation is made.
-        self.q_diag = q_diag
+        self._q_diag = q_diag
         # Sqrt of the covariance of the posterior
         if self.q_diag:
             self.q_sqrt = Param(np.ones((self.num_data, self.num_latent)),
                                 transforms.positive)
         else:
-            q_sqrt = np.array([np.eye(self.num_data)
-                                for _ in range(self.num_latent)]).swapaxes(0, 2)
-            self.q_sqrt = Param(q_sqrt)  # , transforms.LowerTriangular(q_sqrt.shape[2]))  # Temp remove transform                              transforms.positive)
+            q_sqrt = np.broadcast_to(
+                        np.eye(self.num_data, dtype=np_float_type)[:,:,None],
+                        (self.num_data, self.num_data, self.num_latent)).copy()
+            self.q_sqrt = Param(q_sqrt, PackedLowerTriangular(
+                                        self.num_data, self.num_latent))
+        self._specialize()
         self.KL_analytic = KL_analytic
 
+    @property
+    def q_diag(self):
+        """
+        True for diagonal approximation of q.
+        This is read-only, since the shape of q_sqrt and the methods bound by
+        self._specialize() depend on it.
+        """
+        return self._q_diag
+
     def _compile(self, optimizer=None, **kw):
         """
         Before calling the standard compile function, check to see if the size
@@ -88,9 +158,11 @@ class StVGP(GPModel):
                 self.q_sqrt = Param(np.ones((self.num_data, self.num_latent)),
                                     transforms.positive)
             else:
-                q_sqrt = np.array([np.eye(self.num_data)
-                                    for _ in range(self.num_latent)]).swapaxes(0, 2)
-                self.q_sqrt = Param(q_sqrt)  # , transforms.LowerTriangular(q_sqrt.shape[2]))  # Temp remove transform                              transforms.positive)
+                q_sqrt = np.broadcast_to(
+                            np.eye(self.num_data, dtype=np_float_type)[:,:,None],
+                            (self.num_data, self.num_data, self.num_latent)).copy()
+                self.q_sqrt = Param(q_sqrt, PackedLowerTriangular(
+                                            self.num_data, self.num_latent))
         return super(StVGP, self)._compile(optimizer=optimizer, **kw)
 
     def build_likelihood(self):
@@ -98,13 +170,17 @@ class StVGP(GPModel):
         This method computes the variational lower bound on the likelihood, with
         stochastic approximation.
         """
-        f_samples = self._sample(self.num_samples)
+        # The factor of the posterior covariance is shared by the samples and KL
+        sqrt = self._sqrt()
+        f_samples = self._sample(self.num_samples, sqrt, antithetic=True)
         # In likelihood, dimensions of f_samples and self.Y must be matched.
         lik = tf.reduce_sum(self.likelihood.logp(f_samples, self.Y))
-        if not self.KL_analytic:
-            return (lik - self._KL)/self.num_samples
-        else:
-            return lik/self.num_samples - self._analytical_KL()
+        # The stochastic approximation of KL[q(f)||p(f)] with u = mu + sqrt*v,
+        #     -0.5*logdet(S) - 0.5*sum(v^2) + 0.5*sum(u^2),
+        # is replaced by its expectation over v, which is the analytical KL.
+        # It has no variance and needs no pass over the samples.
+        return lik/tf.cast(self.num_samples, float_type) \
+                                            - self._analytical_KL(sqrt)
 
     def build_predict(self, Xnew, full_cov=False):
         """
@@ -141,55 +217,128 @@ class StVGP(GPModel):
         f_samples = self._sample(n_sample[0])
         return self.likelihood.sample_Y(f_samples)
 
-    def _sample(self, N):
+    def _sample(self, N, sqrt=None, antithetic=False):
         """
         :param integer N: number of samples
+        :param tf.tensor sqrt: factor of the posterior covariance given by
+                               self._sqrt(). Computed if None.
+        :param bool antithetic: True for using antithetic pairs of samples,
+                                (v, -v), to reduce the variance of the
+                                Monte-Carlo integration.
         :Returns
-         samples picked from the variational posterior.
-         The Kulback_leibler divergence is stored as self._KL
+         samples picked from the variational posterior, sized [N,n,R]
         """
         n = self.num_data
         R = self.num_latent
-        # Match dimension of the posterior variance to the data.
-        if self.q_diag:
-            sqrt = tf.batch_matrix_diag(tf.transpose(self.q_sqrt)) # [R,n,n]
-        else:
-            sqrt = tf.batch_matrix_band_part(
-                            tf.transpose(self.q_sqrt,[2,0,1]), -1, 0) # [R,n,n]
-        # Log determinant of matrix S = q_sqrt * q_sqrt^T
-        logdet_S = tf.cast(N, float_type)*tf.reduce_sum(
-                tf.log(tf.square(tf.batch_matrix_diag_part(sqrt))))
-        sqrt = tf.tile(tf.expand_dims(sqrt, 1), [1,N,1,1]) # [R,N,n,n]
-        # noraml random samples, [R,N,n,1]
-        v_samples = tf.random_normal([R,N,n,1], dtype=float_type)
-        # Match dimension of the posterior mean, [R,N,n,1]
-        mu = tf.tile(tf.expand_dims(tf.expand_dims(
-                                tf.transpose(self.q_mu), 1), -1), [1,N,1,1])
-        u_samples = mu + tf.batch_matmul(sqrt, v_samples)
-        # Stochastic approximation of the Kulback_leibler KL[q(f)||p(f)]
-        self._KL = - 0.5 * logdet_S\
-             - 0.5 * tf.reduce_sum(tf.square(v_samples)) \
-             + 0.5 * tf.reduce_sum(tf.square(u_samples))
-        # Cholesky factor of kernel [R,N,n,n]
-        L = tf.tile(tf.expand_dims(
-                tf.transpose(self.kern.Cholesky(self.X), [2,0,1]),1), [1,N,1,1])
-        # mean, sized [N,n,R]
-        mean = tf.tile(tf.expand_dims(
-                    self.mean_function(self.X),
-                0), [N,1,1])
+        # Factor of the posterior covariance, [R,n] for q_diag else [R,n,n]
+        if sqrt is None:
+            sqrt = self._sqrt()
+        # normal random samples, [R,n,N]
+        # For these small sizes, the random number generation on GPU is
+        # dominated by the launch overhead.
+        with tf.device('/cpu:0'):
+            if antithetic:
+                # The last sample does not have its pair for odd N.
+                v_half = tf.random_normal([R,n,(N+1)//2], dtype=float_type)
+                v_samples = tf.slice(tf.concat(2, [v_half, -v_half]),
+                                     [0,0,0], [R,n,N])
+            else:
+                v_samples = tf.random_normal([R,n,N], dtype=float_type)
+        # Cholesky factor of kernel [R,n,n]
+        L = tf.transpose(self.kern.Cholesky(self.X), [2,0,1])
+        # L*(mu + sqrt*v) + mean is computed as L*sqrt*v + bias,
+        # where bias = L*mu + mean sized [n,R] is added only once to the
+        # samples by broadcasting.
+        bias = tf.transpose(tf.squeeze(tf.batch_matmul(
+                    L, tf.expand_dims(tf.transpose(self.q_mu), -1)), [-1]))
+        # Skip the zero mean function
+        if not isinstance(self.mean_function, Zero):
+            bias = bias + self.mean_function(self.X)
+        f_samples = self._transform_samples(L, sqrt, v_samples) # [R,n,N]
         # sample from posterior, [N,n,R]
-        f_samples = tf.transpose(
-                tf.squeeze(tf.batch_matmul(L, u_samples),[-1]), # [R,N,n]
-                [1,2,0]) + mean
-        # return as Dict to deal with
-        return f_samples
+        return tf.transpose(f_samples, [2,1,0]) + bias
 
-    def _analytical_KL(self):
+    def _analytical_KL(self, sqrt):
         """
-        Analytically evaluate KL
+        Analytically evaluate KL[q(u)||p(u)] with p(u) = N(0,I)
+        :param tf.tensor sqrt: factor of the posterior covariance,
+                               given by self._sqrt()
         """
-        if self.q_diag:
-            KL = kullback_leiblers.gauss_kl_white_diag(self.q_mu, self.q_sqrt)
-        else:
-            KL = kullback_leiblers.gauss_kl_white(self.q_mu, self.q_sqrt)
-        return KL
+        # The sums are kept in float_type. KL is deterministic and is also
+        # used by scipy's optimizers, whose line search needs the precision.
+        return 0.5 * (tf.reduce_sum(tf.square(self.q_mu))
+                    + tf.reduce_sum(tf.square(sqrt))
+                    - self._logdet(sqrt)
+                    - float(self.num_data*self.num_latent))
+
+    # Methods that depend on q_diag.
+    # The variant for q_diag (suffix _qdiag) or full q_sqrt (suffix _qfull) is
+    # bound once by self._specialize(), so that q_diag is not checked at every
+    # graph construction.
+    _specialized_methods = ['_sqrt', '_transform_samples', '_logdet']
+
+    def _specialize(self):
+        suffix = '_qdiag' if self.q_diag else '_qfull'
+        for name in self._specialized_methods:
+            setattr(self, name, getattr(self, name + suffix))
+
+    def __getstate__(self):
+        # bound methods are not picklable in python 2.
+        d = GPModel.__getstate__(self)
+        for name in self._specialized_methods:
+            d.pop(name, None)
+        return d
+
+    def __setstate__(self, d):
+        GPModel.__setstate__(self, d)
+        self._specialize()
+
+    def _sqrt_qdiag(self):
+        """
+        Returns the diagonal elements of the factor of the posterior
+        covariance, sized [R,n].
+        """
+        return tf.transpose(self.q_sqrt)
+
+    def _sqrt_qfull(self):
+        """
+        Returns the lower triangular factor of the posterior covariance,
+        sized [R,n,n].
+        """
+        # PackedLowerTriangular ensures the upper triangular part is zero.
+        return tf.transpose(self.q_sqrt,[2,0,1])
+
+    def _transform_samples_qdiag(self, L, sqrt, v_samples):
+        """
+        Returns L*sqrt*v_samples sized [R,n,N]
+        :param tf.tensor L: Cholesky factor of the kernel, [R,n,n]
+        :param tf.tensor sqrt: given by self._sqrt()
+        :param tf.tensor v_samples: normal random samples, [R,n,N]
+        """
+        # product with a diagonal matrix is a column-wise scaling.
+        return tf.batch_matmul(L * tf.expand_dims(sqrt, 1), v_samples)
+
+    def _transform_samples_qfull(self, L, sqrt, v_samples):
+        """
+        Returns L*sqrt*v_samples sized [R,n,N]
+        :param tf.tensor L: Cholesky factor of the kernel, [R,n,n]
+        :param tf.tensor sqrt: given by self._sqrt()
+        :param tf.tensor v_samples: normal random samples, [R,n,N]
+        """
+        # L*(sqrt*v) costs O(2 n^2 N), while (L*sqrt)*v costs O(n^3 + n^2 N).
+        # Since N is only known at run time, the former is always used.
+        return tf.batch_matmul(L, tf.batch_matmul(sqrt, v_samples))
+
+    def _logdet_qdiag(self, sqrt):
+        """
+        Log determinant of matrix S = sqrt * sqrt^T
+        """
+        # log(d^2) = 2*log|d|
+        return 2.0*tf.reduce_sum(tf.log(tf.abs(sqrt)))
+
+    def _logdet_qfull(self, sqrt):
+        """
+        Log determinant of matrix S = sqrt * sqrt^T
+        """
+        # log(d^2) = 2*log|d|
+        return 2.0*tf.reduce_sum(tf.log(tf.abs(tf.batch_matrix_diag_part(sqrt))))
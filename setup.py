@@ -31,7 +31,7 @@ setup(name='GPinv',
       py_modules=['GPinv.__init__'],
       test_suite='testing',
       #install_requires=['numpy>=1.9', 'scipy>=0.16', 'tensorflow>=0.9', 'GPflow>=0.3.0'],
-      install_requires=['numpy>=1.9', 'scipy>=0.16', 'tensorflow>=0.9'],
+      install_requires=['numpy>=1.10', 'scipy>=0.16', 'tensorflow>=0.9'],
       classifiers=['License :: OSI Approved :: BSD License',
                    'Natural Language :: English',
                    'Operating System :: MacOS :: MacOS X',
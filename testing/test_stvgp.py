@@ -1,7 +1,9 @@
 import numpy as np
+import pickle
 import unittest
 import tensorflow as tf
 import GPflow
+import GPflow.kullback_leiblers
 import GPinv
 
 class test_vgp(unittest.TestCase):
@@ -68,6 +70,62 @@ class test_vgp(unittest.TestCase):
         self.assertTrue(np.allclose(f_samples.shape, [num_samples,self.X.shape[0], 1]))
         y_samples = m.sample_Y(num_samples)
         self.assertTrue(np.allclose(y_samples.shape, [num_samples,self.X.shape[0], 1]))
+        # odd number of samples
+        num_samples = 11
+        f_samples = m.sample_F(num_samples)
+        self.assertTrue(np.allclose(f_samples.shape, [num_samples,self.X.shape[0], 1]))
+        y_samples = m.sample_Y(num_samples)
+        self.assertTrue(np.allclose(y_samples.shape, [num_samples,self.X.shape[0], 1]))
+
+    def test_odd_num_samples(self):
+        """
+        The likelihood with antithetic samples for odd num_samples.
+        """
+        m = GPinv.stvgp.StVGP(self.X.reshape(-1,1), self.Y.reshape(-1,1),
+                    GPinv.kernels.RBF(1,output_dim=1),
+                    GPinv.likelihoods.Gaussian(),
+                    num_samples=3)
+        m._compile()
+        f, g = m._objective(m.get_free_state())
+        self.assertTrue(np.isfinite(f))
+        self.assertTrue(np.all(np.isfinite(g)))
+
+    def test_num_samples(self):
+        """
+        Change of num_samples should not require recompilation.
+        """
+        m = GPinv.stvgp.StVGP(self.X.reshape(-1,1), self.Y.reshape(-1,1),
+                    GPinv.kernels.RBF(1,output_dim=1),
+                    GPinv.likelihoods.Gaussian(),
+                    num_samples=10)
+        tf.set_random_seed(1)
+        m._compile()
+        x = m.get_free_state()
+        # The variance of the stochastic bound should decrease with N.
+        m.num_samples.set_data(np.array(2))
+        self.assertFalse(m._needs_recompile)
+        f_2 = [m._objective(x)[0] for _ in range(50)]
+        m.num_samples.set_data(np.array(40))
+        self.assertFalse(m._needs_recompile)
+        f_40 = [m._objective(x)[0] for _ in range(50)]
+        self.assertTrue(np.var(f_40) < np.var(f_2))
+
+    def test_pickle(self):
+        """
+        The methods bound by _specialize should be restored after unpickling.
+        """
+        for q_diag in [False, True]:
+            m = GPinv.stvgp.StVGP(self.X.reshape(-1,1), self.Y.reshape(-1,1),
+                        GPinv.kernels.RBF(1,output_dim=1),
+                        GPinv.likelihoods.Gaussian(),
+                        q_diag=q_diag)
+            m2 = pickle.loads(pickle.dumps(m))
+            self.assertTrue(m2.q_diag == q_diag)
+            m2._compile()
+            m2.optimize(maxiter=2)
+            # q_diag cannot be changed after the construction
+            with self.assertRaises(AttributeError):
+                m2.q_diag = not q_diag
 
     def test_KL_analytic(self):
         """
@@ -94,5 +152,98 @@ class test_vgp(unittest.TestCase):
         rslt = m.optimize(trainer, maxiter=3000)
 
 
+class test_packed_lower_triangular(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.transform = GPinv.stvgp.PackedLowerTriangular(5, 3)
+        self.x = rng.randn(5*6//2*3)
+
+    def test_forward_backward(self):
+        y = self.transform.forward(self.x)
+        self.assertTrue(np.allclose(y.shape, [5,5,3]))
+        for i in range(y.shape[2]):
+            self.assertTrue(np.allclose(y[:,:,i], np.tril(y[:,:,i])))
+        self.assertTrue(np.allclose(self.transform.backward(y.flatten()), self.x))
+
+    def test_tf_forward(self):
+        y = self.transform.forward(self.x)
+        y_tf = tf.Session().run(self.transform.tf_forward(tf.constant(self.x)))
+        self.assertTrue(np.allclose(y, y_tf))
+
+    def test_model(self):
+        """
+        Round trip through the free state of the full-rank StVGP.
+        """
+        rng = np.random.RandomState(0)
+        X = np.linspace(0.,1.,5).reshape(-1,1)
+        Y = rng.randn(5,3)
+        m = GPinv.stvgp.StVGP(X, Y, GPinv.kernels.RBF(1,output_dim=3),
+                              GPinv.likelihoods.Gaussian())
+        q_sqrt = rng.randn(5,5,3)
+        q_sqrt[np.triu_indices(5,1)] = 0.
+        m.q_sqrt = q_sqrt
+        m.set_state(m.get_free_state())
+        self.assertTrue(np.allclose(m.q_sqrt.value, q_sqrt))
+        m._compile()
+        with m.tf_mode():
+            q_sqrt_tf = m._session.run(m.q_sqrt)
+        self.assertTrue(np.allclose(q_sqrt_tf, m.q_sqrt.value))
+
+    def test_upper_triangular(self):
+        """
+        The upper triangular part of q_sqrt should be kept exactly zero
+        during the optimization, as _sqrt does not mask it.
+        """
+        rng = np.random.RandomState(0)
+        X = np.linspace(0.,1.,5).reshape(-1,1)
+        Y = rng.randn(5,3)
+        m = GPinv.stvgp.StVGP(X, Y, GPinv.kernels.RBF(1,output_dim=3),
+                              GPinv.likelihoods.Gaussian())
+        trainer = tf.train.AdamOptimizer(learning_rate=0.01)
+        m.optimize(trainer, maxiter=10)
+        with m.tf_mode():
+            q_sqrt_tf = m._session.run(m.q_sqrt)
+        for q in [q_sqrt_tf, m.q_sqrt.value]:
+            self.assertTrue(np.all(q[np.triu_indices(5,1)] == 0.))
+
+class test_analytical_KL(unittest.TestCase):
+    """
+    Compare StVGP._analytical_KL with GPflow's implementation.
+    """
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.X = np.linspace(0.,1.,5).reshape(-1,1)
+        self.Y = self.rng.randn(5,3)
+
+    def _get_KL(self, m, KL_ref):
+        tf_array = m.get_free_state()
+        m.make_tf_array(tf_array)
+        sess = tf.Session()
+        with m.tf_mode():
+            KL = sess.run(m._analytical_KL(m._sqrt()))
+            KL_ref = sess.run(KL_ref(m.q_mu, m.q_sqrt))
+        return KL, KL_ref
+
+    def test_full(self):
+        m = GPinv.stvgp.StVGP(self.X, self.Y,
+                              GPinv.kernels.RBF(1,output_dim=3),
+                              GPinv.likelihoods.Gaussian())
+        m.q_mu = self.rng.randn(5,3)
+        q_sqrt = self.rng.randn(5,5,3)
+        q_sqrt[np.triu_indices(5,1)] = 0.
+        m.q_sqrt = q_sqrt
+        KL, KL_ref = self._get_KL(m, GPflow.kullback_leiblers.gauss_kl_white)
+        self.assertTrue(np.allclose(KL, KL_ref))
+
+    def test_qdiag(self):
+        m = GPinv.stvgp.StVGP(self.X, self.Y,
+                              GPinv.kernels.RBF(1,output_dim=3),
+                              GPinv.likelihoods.Gaussian(), q_diag=True)
+        m.q_mu = self.rng.randn(5,3)
+        m.q_sqrt = np.exp(self.rng.randn(5,3))
+        KL, KL_ref = self._get_KL(m, GPflow.kullback_leiblers.gauss_kl_white_diag)
+        self.assertTrue(np.allclose(KL, KL_ref))
+
+
 if __name__ == '__main__':
     unittest.main()